@@ -0,0 +1,68 @@
+import argparse
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from updown.config import Config
+from updown.data.readers import ConstraintBoxesReader
+from updown.utils.constraints import ConstraintFilter
+
+
+parser = argparse.ArgumentParser(
+    description="Filter CBS constraints for all images once, and save them in an H5 file which "
+    "can be provided as DATA.CBS.INFER_CONSTRAINTS during inference."
+)
+parser.add_argument(
+    "--config", required=True, help="Path to a config file with all configuration parameters."
+)
+parser.add_argument(
+    "--config-override",
+    default=[],
+    nargs="*",
+    help="A sequence of key-value pairs specifying certain config arguments (with dict-like "
+    "nesting) using a dot operator.",
+)
+parser.add_argument(
+    "-o",
+    "--output-h5path",
+    default="data/nocaps_val_cbs_constraints.h5",
+    help="Path to save an H5 file containing constraints for all images.",
+)
+
+
+if __name__ == "__main__":
+
+    _A = parser.parse_args()
+    _C = Config(_A.config, _A.config_override)
+
+    print(f"Loading boxes from {_C.DATA.CBS.INFER_BOXES}...")
+    boxes_reader = ConstraintBoxesReader(_C.DATA.CBS.INFER_BOXES)
+    constraint_filter = ConstraintFilter(
+        _C.DATA.CBS.CLASS_HIERARCHY, _C.DATA.CBS.NMS_THRESHOLD, _C.DATA.CBS.MAX_GIVEN_CONSTRAINTS
+    )
+
+    print("Filtering constraints for all images...")
+    image_ids = boxes_reader.image_ids
+    constraints = np.full((len(image_ids), _C.DATA.CBS.MAX_GIVEN_CONSTRAINTS), "", dtype=object)
+
+    for index, image_id in enumerate(tqdm(image_ids)):
+        constraint_boxes = boxes_reader[image_id]
+        candidates = constraint_filter(
+            constraint_boxes["boxes"], constraint_boxes["class_names"], constraint_boxes["scores"]
+        )
+        # Pad with empty strings up to maximum number of constraints.
+        constraints[index, : len(candidates)] = candidates
+
+    print(f"Writing constraints to {_A.output_h5path}...")
+    with h5py.File(_A.output_h5path, "w") as constraints_h5:
+        constraints_h5["image_id"] = np.array(image_ids, dtype=np.int64)
+        constraints_h5.create_dataset(
+            "constraints", data=constraints, dtype=h5py.special_dtype(vlen=str)
+        )
+
+        # Record settings used for filtering, these are checked by ``ConstraintsReader``.
+        constraints_h5.attrs["boxes_jsonpath"] = _C.DATA.CBS.INFER_BOXES
+        constraints_h5.attrs["hierarchy_jsonpath"] = _C.DATA.CBS.CLASS_HIERARCHY
+        constraints_h5.attrs["nms_threshold"] = _C.DATA.CBS.NMS_THRESHOLD
+        constraints_h5.attrs["max_given_constraints"] = _C.DATA.CBS.MAX_GIVEN_CONSTRAINTS
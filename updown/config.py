@@ -77,6 +77,10 @@ class Config(object):
         Path to a TSV file containing word-forms of CBS constraints. First column is a word in
         Open Images class names, second column are comma separated word-forms (singular, plural
         etc.) which can satisfy the constraint.
+    DATA.CBS.INFER_CONSTRAINTS: ""
+        Path to an H5 file containing CBS constraints of nocaps val/test images, filtered
+        beforehand from ``DATA.CBS.INFER_BOXES`` by ``scripts/build_constraints.py``. Constraints
+        are filtered on the fly during inference if this is empty.
     DATA.CBS.NMS_THRESHOLD: 0.85
         NMS threshold for suppressing generic object class names during constraint filtering,
         for two boxes with IoU higher than this threshold, "dog" suppresses "animal".
@@ -148,6 +152,7 @@ class Config(object):
         _C.DATA.CBS.INFER_BOXES = "data/nocaps_val_oi_detector_boxes.json"
         _C.DATA.CBS.CLASS_HIERARCHY = "data/cbs/class_hierarchy.json"
         _C.DATA.CBS.WORDFORMS = "data/cbs/constraint_wordforms.tsv"
+        _C.DATA.CBS.INFER_CONSTRAINTS = ""
 
         _C.DATA.CBS.NMS_THRESHOLD = 0.85
         _C.DATA.CBS.MAX_GIVEN_CONSTRAINTS = 3
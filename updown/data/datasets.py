@@ -1,4 +1,4 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import numpy as np
 import torch
@@ -6,7 +6,12 @@ from torch.utils.data import Dataset
 from allennlp.data import Vocabulary
 
 from updown.config import Config
-from updown.data.readers import CocoCaptionsReader, ConstraintBoxesReader, ImageFeaturesReader
+from updown.data.readers import (
+    CocoCaptionsReader,
+    ConstraintBoxesReader,
+    ConstraintsReader,
+    ImageFeaturesReader,
+)
 from updown.types import (
     TrainingInstance,
     TrainingBatch,
@@ -211,6 +216,11 @@ class EvaluationDatasetWithConstraints(EvaluationDataset):
         selected based on the prediction confidence score of their corresponding bounding boxes.
     in_memory: bool, optional (default = True)
         Whether to load all image features in memory.
+    constraints_h5path: str, optional (default = None)
+        Path to an H5 file containing constraints of all images, filtered beforehand by
+        ``scripts/build_constraints.py``. If provided, ``boxes_jsonpath`` and
+        ``hierarchy_jsonpath`` are not read, and constraints are not filtered on the fly. The
+        settings saved in this file must match ``nms_threshold`` and ``max_given_constraints``.
     """
 
     def __init__(
@@ -224,17 +234,27 @@ class EvaluationDatasetWithConstraints(EvaluationDataset):
         max_given_constraints: int = 3,
         max_words_per_constraint: int = 3,
         in_memory: bool = True,
+        constraints_h5path: Optional[str] = None,
     ):
         super().__init__(image_features_h5path, in_memory=in_memory)
 
         self._vocabulary = vocabulary
         self._pad_index = vocabulary.get_token_index("@@UNKNOWN@@")
 
-        self._boxes_reader = ConstraintBoxesReader(boxes_jsonpath)
-
-        self._constraint_filter = ConstraintFilter(
-            hierarchy_jsonpath, nms_threshold, max_given_constraints
-        )
+        if constraints_h5path is not None:
+            self._constraints_reader = ConstraintsReader(
+                constraints_h5path,
+                boxes_jsonpath,
+                hierarchy_jsonpath,
+                nms_threshold,
+                max_given_constraints,
+            )
+        else:
+            self._constraints_reader = None
+            self._boxes_reader = ConstraintBoxesReader(boxes_jsonpath)
+            self._constraint_filter = ConstraintFilter(
+                hierarchy_jsonpath, nms_threshold, max_given_constraints
+            )
         self._fsm_builder = FiniteStateMachineBuilder(vocabulary, wordforms_tsvpath, max_given_constraints, max_words_per_constraint)
 
     @classmethod
@@ -248,20 +268,28 @@ class EvaluationDatasetWithConstraints(EvaluationDataset):
             boxes_jsonpath=_C.DATA.CBS.INFER_BOXES,
             wordforms_tsvpath=_C.DATA.CBS.WORDFORMS,
             hierarchy_jsonpath=_C.DATA.CBS.CLASS_HIERARCHY,
+            nms_threshold=_C.DATA.CBS.NMS_THRESHOLD,
             max_given_constraints=_C.DATA.CBS.MAX_GIVEN_CONSTRAINTS,
             max_words_per_constraint=_C.DATA.CBS.MAX_WORDS_PER_CONSTRAINT,
             in_memory=kwargs.pop("in_memory"),
+            constraints_h5path=_C.DATA.CBS.INFER_CONSTRAINTS or None,
         )
 
     def __getitem__(self, index: int) -> EvaluationInstanceWithConstraints:
         item: EvaluationInstance = super().__getitem__(index)
 
-        # Apply constraint filtering to object class names.
-        constraint_boxes = self._boxes_reader[item["image_id"]]
-
-        candidates: List[str] = self._constraint_filter(
-            constraint_boxes["boxes"], constraint_boxes["class_names"], constraint_boxes["scores"]
-        )
+        if self._constraints_reader is not None:
+            # Use constraints filtered beforehand.
+            candidates: List[str] = self._constraints_reader[item["image_id"]]
+        else:
+            # Apply constraint filtering to object class names.
+            constraint_boxes = self._boxes_reader[item["image_id"]]
+
+            candidates = self._constraint_filter(
+                constraint_boxes["boxes"],
+                constraint_boxes["class_names"],
+                constraint_boxes["scores"],
+            )
         fsm, nstates = self._fsm_builder.build(candidates)
 
         return {"fsm": fsm, "num_states": nstates, "num_constraints": len(candidates), **item}
@@ -272,8 +300,13 @@ class EvaluationDatasetWithConstraints(EvaluationDataset):
 
         batch = super().collate_fn(batch_list)
 
+        # Expand finite state machines directly into a batch tensor, trimmed to the maximum
+        # number of used states. Unused sub-states have no transitions, so nothing is lost.
         max_state = max([s["num_states"] for s in batch_list])
-        fsm = torch.stack([s["fsm"][:max_state, :max_state, :] for s in batch_list])
+        vocab_size = self._vocabulary.get_vocab_size()
+        fsm = torch.zeros(len(batch_list), max_state, max_state, vocab_size, dtype=torch.uint8)
+        for i, s in enumerate(batch_list):
+            s["fsm"].to_tensor(out=fsm[i])
         num_candidates = torch.tensor([s["num_constraints"] for s in batch_list]).long()
 
         batch.update({"fsm": fsm, "num_constraints": num_candidates})
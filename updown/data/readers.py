@@ -7,7 +7,9 @@ an image through a pre-trained CNN. Each reader must implement at least two meth
     1. ``__len__`` to return the length of data this Reader can read.
     2. ``__getitem__`` to return data based on an index or a primary key (such as ``image_id``).
 """
+import itertools
 import json
+import warnings
 from typing import Any, Dict, List, Tuple, Union
 
 import h5py
@@ -17,6 +19,12 @@ from tqdm import tqdm
 
 from updown.types import ConstraintBoxes
 
+try:
+    # Optional, parses large JSON files a few times faster than ``json``.
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class ImageFeaturesReader(object):
     r"""
@@ -155,34 +163,165 @@ class ConstraintBoxesReader(object):
 
     def __init__(self, boxes_jsonpath: str):
 
-        _boxes = json.load(open(boxes_jsonpath))
-
-        # Form a mapping between Image ID and corresponding boxes from OI Detector.
-        self._image_id_to_boxes: Dict[int, Any] = {}
-
-        for ann in _boxes["annotations"]:
-            if ann["image_id"] not in self._image_id_to_boxes:
-                self._image_id_to_boxes[ann["image_id"]] = []
-
-            self._image_id_to_boxes[ann["image_id"]].append(ann)
+        with open(boxes_jsonpath, "rb") as boxes_file:
+            boxes_json = boxes_file.read()
+        _boxes = orjson.loads(boxes_json) if orjson is not None else json.loads(boxes_json)
 
         # A list of Open Image object classes. Index of a class in this list is its Open Images
         # class ID. Open Images class IDs start from 1, so zero-th element is "__background__".
         self._class_names = [c["name"] for c in _boxes["categories"]]
 
+        # Sort bounding box detections from OI Detector (in COCO format) by Image ID. Sorting is
+        # stable, so detections of an image stay in their original order.
+        annotations = sorted(_boxes["annotations"], key=lambda ann: ann["image_id"])
+
+        # Keep detections of all images as contiguous arrays, detections of a single image are a
+        # slice of these. Unlike lists of Python objects, these are shared (copy-on-write) with
+        # forked :class:`~torch.utils.data.DataLoader` workers instead of being copied to each.
+        # ``np.fromiter`` with known dtype and count avoids building intermediate Python lists.
+        num_boxes = len(annotations)
+        self._boxes = np.fromiter(
+            itertools.chain.from_iterable(ann["bbox"] for ann in annotations),
+            dtype=np.float64,
+            count=4 * num_boxes,
+        ).reshape(num_boxes, 4)
+        self._box_class_ids = np.fromiter(
+            (ann["category_id"] for ann in annotations), dtype=np.int64, count=num_boxes
+        )
+        self._scores = np.fromiter(
+            (ann.get("score", 1) for ann in annotations), dtype=np.float64, count=num_boxes
+        )
+
+        # Form a mapping between Image ID and (start, end) offsets of its detections.
+        image_ids, starts, counts = np.unique(
+            np.fromiter((ann["image_id"] for ann in annotations), dtype=np.int64, count=num_boxes),
+            return_index=True,
+            return_counts=True,
+        )
+        self._image_id_to_offsets: Dict[int, Tuple[int, int]] = {
+            int(image_id): (int(start), int(start + count))
+            for image_id, start, count in zip(image_ids, starts, counts)
+        }
+
     def __len__(self) -> int:
-        return len(self._image_id_to_boxes)
+        return len(self._image_id_to_offsets)
+
+    @property
+    def image_ids(self) -> List[int]:
+        r"""Image IDs of all images having at least one bounding box detection."""
+        return list(self._image_id_to_offsets.keys())
 
     def __getitem__(self, image_id: int) -> ConstraintBoxes:
 
-        # List of bounding box detections from OI detector in COCO format.
         # Some images may not have any boxes, handle that case too.
-        bbox_anns = self._image_id_to_boxes.get(int(image_id), [])
-
-        boxes = np.array([ann["bbox"] for ann in bbox_anns])
-        scores = np.array([ann.get("score", 1) for ann in bbox_anns])
+        start, end = self._image_id_to_offsets.get(int(image_id), (0, 0))
 
         # Convert object class IDs to their names.
-        class_names = [self._class_names[ann["category_id"]] for ann in bbox_anns]
+        class_names = [self._class_names[class_id] for class_id in self._box_class_ids[start:end]]
+
+        return {
+            "boxes": self._boxes[start:end],
+            "class_names": class_names,
+            "scores": self._scores[start:end],
+        }
+
+
+class ConstraintsReader(object):
+    r"""
+    A reader for H5 files containing CBS constraints (Open Images object class names) of images,
+    as filtered by :class:`~updown.utils.constraints.ConstraintFilter`. Constraint filtering is
+    deterministic, so it can be done once for all images using ``scripts/build_constraints.py``,
+    instead of being repeated in every inference run.
+
+    Example of an h5 file::
+
+        nocaps_val_cbs_constraints.h5
+        |--- "image_id" [shape: (num_images, )]
+        |--- "constraints" [shape: (num_images, max_given_constraints)]
+        +--- .attrs {"boxes_jsonpath": ..., "hierarchy_jsonpath": ..., "nms_threshold": 0.85,
+                     "max_given_constraints": 3}
+
+    Rows of constraints are padded with empty strings. Images which are not present in the file
+    (because they had no detections) have no constraints. The settings used for filtering are
+    saved as attributes, and must match the settings this reader is used with, else the FSMs
+    built from these constraints would be wrong.
+
+    Parameters
+    ----------
+    constraints_h5path: str
+        Path to an H5 file containing image ids and their constraints.
+    boxes_jsonpath: str
+        Path to a JSON file containing bounding box detections which constraints should have been
+        filtered from. A warning is raised if the file was built from a different path.
+    hierarchy_jsonpath: str
+        Path to a JSON file containing a hierarchy of Open Images object classes. A warning is
+        raised if the file was built from a different path.
+    nms_threshold: float
+        NMS threshold which constraints should have been filtered with.
+    max_given_constraints: int
+        Maximum number of constraints per image, which the FSMs are built for.
+    """
+
+    def __init__(
+        self,
+        constraints_h5path: str,
+        boxes_jsonpath: str,
+        hierarchy_jsonpath: str,
+        nms_threshold: float,
+        max_given_constraints: int,
+    ):
+        self.constraints_h5path = constraints_h5path
+
+        # These are small, always load them in memory.
+        with h5py.File(self.constraints_h5path, "r") as constraints_h5:
+            image_id_np = np.array(constraints_h5["image_id"])
+            constraints_np = constraints_h5["constraints"][:]
+            attrs = dict(constraints_h5.attrs)
+
+        required_attrs = [
+            "boxes_jsonpath", "hierarchy_jsonpath", "nms_threshold", "max_given_constraints"
+        ]
+        for name in required_attrs:
+            if name not in attrs:
+                raise ValueError(f"{constraints_h5path} does not record {name}, rebuild it.")
+
+        # Files may have been moved, paths are only a hint.
+        for name, expected in [
+            ("boxes_jsonpath", boxes_jsonpath),
+            ("hierarchy_jsonpath", hierarchy_jsonpath),
+        ]:
+            if attrs[name] != expected:
+                warnings.warn(
+                    f"{constraints_h5path} was built from {name} {attrs[name]}, "
+                    f"but {expected} is specified."
+                )
+
+        if not np.isclose(attrs["nms_threshold"], nms_threshold):
+            raise ValueError(
+                f"{constraints_h5path} was built with NMS threshold {attrs['nms_threshold']}, "
+                f"but {nms_threshold} is specified."
+            )
+        if attrs["max_given_constraints"] != max_given_constraints:
+            raise ValueError(
+                f"{constraints_h5path} was built with {attrs['max_given_constraints']} max "
+                f"given constraints, but {max_given_constraints} are specified."
+            )
+        if constraints_np.shape[1] > max_given_constraints:
+            raise ValueError(
+                f"{constraints_h5path} has up to {constraints_np.shape[1]} constraints per image, "
+                f"more than {max_given_constraints} max given constraints."
+            )
+
+        self._image_id_to_constraints: Dict[int, List[str]] = {}
+        for image_id, image_constraints in zip(image_id_np, constraints_np):
+            # Variable length strings may be read as bytes, depending on the version of h5py.
+            image_constraints = [
+                c.decode("utf-8") if isinstance(c, bytes) else c for c in image_constraints
+            ]
+            self._image_id_to_constraints[int(image_id)] = [c for c in image_constraints if c]
+
+    def __len__(self) -> int:
+        return len(self._image_id_to_constraints)
 
-        return {"boxes": boxes, "class_names": class_names, "scores": scores}
+    def __getitem__(self, image_id: int) -> List[str]:
+        return self._image_id_to_constraints.get(int(image_id), [])
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Any, List
 
 from mypy_extensions import TypedDict
 import numpy as np
@@ -30,7 +30,9 @@ EvaluationInstanceWithConstraints = TypedDict(
     {
         "image_id": int,
         "image_features": np.ndarray,
-        "fsm": torch.ByteTensor,
+        # A :class:`~updown.utils.constraints.FiniteStateMachine`, not imported here to keep
+        # this module free of dependencies on the rest of the package.
+        "fsm": Any,
         "num_states": int,
         "num_constraints": int,
     },
@@ -4,7 +4,7 @@ for performing Constrained Beam Search.
 """
 import csv
 import json
-from typing import Dict, List, Optional
+from typing import Dict, FrozenSet, List, Optional
 
 import anytree
 from anytree.search import findall
@@ -80,7 +80,7 @@ class ConstraintFilter(object):
     """
 
     # fmt: off
-    BLACKLIST: List[str] = [
+    BLACKLIST: FrozenSet[str] = frozenset({
         "auto part", "bathroom accessory", "bicycle wheel", "boy", "building", "clothing",
         "door handle", "fashion accessory", "footwear", "girl", "hiking equipment", "human arm",
         "human beard", "human body", "human ear", "human eye", "human face", "human foot",
@@ -88,7 +88,7 @@ class ConstraintFilter(object):
         "land vehicle", "mammal", "man", "person", "personal care", "plant", "plumbing fixture",
         "seat belt", "skull", "sports equipment", "tire", "tree", "vehicle registration plate",
         "wheel", "woman"
-    ]
+    })
     # fmt: on
 
     REPLACEMENTS: Dict[str, str] = {
@@ -119,49 +119,45 @@ class ConstraintFilter(object):
         self._nms_threshold = nms_threshold
         self._max_given_constraints = max_given_constraints
 
+        # Cache of heights of object classes in the hierarchy tree, keyed by class name. Filled
+        # lazily by :meth:`_get_height`, the same classes recur across many images.
+        self._heights: Dict[str, int] = {}
+
     def __call__(self, boxes: np.ndarray, class_names: List[str], scores: np.ndarray) -> List[str]:
 
         # Remove padding boxes (which have prediction confidence score = 0), and remove boxes
         # corresponding to all blacklisted classes. These will never become CBS constraints.
-        keep_indices = []
-        for i in range(len(class_names)):
-            if scores[i] > 0 and class_names[i] not in self.BLACKLIST:
-                keep_indices.append(i)
+        blacklisted = np.array([c in self.BLACKLIST for c in class_names], dtype=np.bool_)
+        keep_indices = np.flatnonzero((scores > 0) & ~blacklisted)
 
-        boxes = boxes[keep_indices]
-        class_names = [class_names[i] for i in keep_indices]
-        scores = scores[keep_indices]
+        # For object class, get the height of its corresponding node in the hierarchy tree.
+        # Less height => finer-grained class name => higher score.
+        heights = np.array([self._get_height(class_names[i]) for i in keep_indices])
 
         # Perform non-maximum suppression according to category hierarchy. For example, for highly
         # overlapping boxes on a dog, "dog" suppresses "animal".
-        keep_indices = self._nms(boxes, class_names)
-        boxes = boxes[keep_indices]
+        nms_indices = self._nms(boxes[keep_indices], heights)
+
+        # Compose both selections, and gather class names and scores from the inputs only once.
+        keep_indices = keep_indices[nms_indices]
         class_names = [class_names[i] for i in keep_indices]
         scores = scores[keep_indices]
 
-        # Retain top-k constraints based on prediction confidence score.
-        class_names_and_scores = sorted(list(zip(class_names, scores)), key=lambda t: -t[1])
-        class_names_and_scores = class_names_and_scores[: self._max_given_constraints]
+        # Retain top-k constraints based on prediction confidence score. Use a stable sort, so
+        # boxes with tied scores are taken in their original order.
+        top_indices = np.argsort(-scores, kind="mergesort")[: self._max_given_constraints]
 
         # Replace class name according to ``self.REPLACEMENTS``.
-        class_names = [self.REPLACEMENTS.get(t[0], t[0]) for t in class_names_and_scores]
+        class_names = [self.REPLACEMENTS.get(class_names[i], class_names[i]) for i in top_indices]
 
         # Drop duplicates.
         class_names = list(set(class_names))
         return class_names
 
-    def _nms(self, boxes: np.ndarray, class_names: List[str]):
-        if len(class_names) == 0:
+    def _nms(self, boxes: np.ndarray, heights: np.ndarray):
+        if len(heights) == 0:
             return []
 
-        # For object class, get the height of its corresponding node in the hierarchy tree.
-        # Less height => finer-grained class name => higher score.
-        heights = np.array(
-            [
-                findall(self._hierarchy, lambda node: node.LabelName.lower() in c)[0].height
-                for c in class_names
-            ]
-        )
         # Get a sorting of the heights in ascending order, i.e. higher scores first.
         score_order = heights.argsort()
 
@@ -204,6 +200,14 @@ class ConstraintFilter(object):
 
         return keep_box_indices
 
+    def _get_height(self, class_name: str) -> int:
+        r"""Get height of the node of this object class in the hierarchy tree (cached)."""
+        if class_name not in self._heights:
+            self._heights[class_name] = findall(
+                self._hierarchy, lambda node: node.LabelName.lower() in class_name
+            )[0].height
+        return self._heights[class_name]
+
 
 class FiniteStateMachineBuilder(object):
     r"""
@@ -222,7 +226,8 @@ class FiniteStateMachineBuilder(object):
 
     .. image:: ../_static/fsm.jpg
 
-    The FSM is representated as an adjacency matrix. Specifically, it is a tensor of shape
+    The FSM is representated as an adjacency matrix (built compactly as a
+    :class:`FiniteStateMachine`, and expanded when batching). Specifically, it is a tensor of shape
     ``(num_total_states, num_total_states, vocab_size)``. In this, ``fsm[S1, S2, W] = 1`` indicates
     a transition from "S1" to "S2" if word "W" is decoded. For example, consider **Figure 9**.
     The decoding is at initial state (``q0``), constraint word is ``D1``, while any other word
@@ -289,13 +294,23 @@ class FiniteStateMachineBuilder(object):
         self._num_main_states = 2 ** max_given_constraints
         self._num_total_states = self._num_main_states * max_words_per_constraint
 
-        self._wordforms: Dict[str, List[str]] = {}
+        # Vocabulary indices of all word-forms of a word, looked up once here instead of every
+        # time a connection is made for the word.
+        self._wordform_indices: Dict[str, List[int]] = {}
         with open(wordforms_tsvpath, "r") as wordforms_file:
             reader = csv.DictReader(
                 wordforms_file, delimiter="\t", fieldnames=["class_name", "words"]
             )
             for row in reader:
-                self._wordforms[row["class_name"]] = row["words"].split(",")
+                self._wordform_indices[row["class_name"]] = [
+                    self._vocabulary.get_token_index(w) for w in row["words"].split(",")
+                ]
+
+        # An FSM without any constraints (only self-loops on main states) is the same for all
+        # examples, and it is never modified after building. Build it once and reuse it.
+        self._unconstrained_fsm = FiniteStateMachine(
+            self._num_main_states, self._num_total_states, self._vocabulary.get_vocab_size()
+        )
 
     def build(self, constraints: List[str]):
         r"""
@@ -309,16 +324,17 @@ class FiniteStateMachineBuilder(object):
 
         Returns
         -------
-        Tuple[torch.Tensor, int]
-            A finite state machine as an adjacency matrix, index of the next available unused
-            sub-state. This is later used to trim the unused sub-states from FSM.
+        Tuple[FiniteStateMachine, int]
+            A finite state machine (which can be expanded to an adjacency matrix by
+            :meth:`FiniteStateMachine.to_tensor`), index of the next available unused sub-state.
+            This is later used to trim the unused sub-states from FSM.
         """
-        fsm = torch.zeros(self._num_total_states, self._num_total_states, dtype=torch.uint8)
+        if len(constraints) == 0:
+            return self._unconstrained_fsm, self._num_main_states
 
-        # Self loops for all words on main states.
-        fsm[range(self._num_main_states), range(self._num_main_states)] = 1
-
-        fsm = fsm.unsqueeze(-1).repeat(1, 1, self._vocabulary.get_vocab_size())
+        fsm = FiniteStateMachine(
+            self._num_main_states, self._num_total_states, self._vocabulary.get_vocab_size()
+        )
 
         substate_idx = self._num_main_states
         for i, constraint in enumerate(constraints):
@@ -326,16 +342,17 @@ class FiniteStateMachineBuilder(object):
 
         return fsm, substate_idx
 
-    def _add_nth_constraint(self, fsm: torch.Tensor, n: int, substate_idx: int, constraint: str):
+    def _add_nth_constraint(
+        self, fsm: "FiniteStateMachine", n: int, substate_idx: int, constraint: str
+    ):
         r"""
         Given an (incomplete) FSM matrix with transitions for "(n - 1)" constraints added, add
         all transitions for the "n-th" constraint.
 
         Parameters
         ----------
-        fsm: torch.Tensor
-            A tensor of shape ``(num_total_states, num_total_states, vocab_size)`` representing an
-            FSM under construction.
+        fsm: FiniteStateMachine
+            An FSM under construction.
         n: int
             The cardinality of constraint to be added. Goes as 1, 2, 3... (not zero-indexed).
         substate_idx: int
@@ -348,7 +365,7 @@ class FiniteStateMachineBuilder(object):
 
         Returns
         -------
-        Tuple[torch.Tensor, int]
+        Tuple[FiniteStateMachine, int]
             FSM with added connections for the constraint and updated ``substate_idx`` pointing to
             the next unused sub-state.
         """
@@ -379,7 +396,12 @@ class FiniteStateMachineBuilder(object):
         return fsm, substate_idx
 
     def _connect(
-        self, fsm: torch.Tensor, from_state: int, to_state: int, word: str, reset_state: int = None
+        self,
+        fsm: "FiniteStateMachine",
+        from_state: int,
+        to_state: int,
+        word: str,
+        reset_state: int = None,
     ):
         r"""
         Add a connection between two states for a particular word (and all its word-forms). This
@@ -396,9 +418,8 @@ class FiniteStateMachineBuilder(object):
 
         Parameters
         ----------
-        fsm: torch.Tensor
-            A tensor of shape ``(num_total_states, num_total_states, vocab_size)`` representing an
-            FSM under construction.
+        fsm: FiniteStateMachine
+            An FSM under construction.
         from_state: int
             Origin state to make a state transition.
         to_state: int
@@ -410,20 +431,115 @@ class FiniteStateMachineBuilder(object):
 
         Returns
         -------
-        torch.Tensor
+        FiniteStateMachine
             FSM with the added connection.
         """
-        wordforms = self._wordforms[word]
-        wordform_indices = [self._vocabulary.get_token_index(w) for w in wordforms]
+        wordform_indices = self._wordform_indices[word]
+        fsm.connect(from_state, to_state, wordform_indices, reset_state=reset_state)
+        return fsm
+
+
+class FiniteStateMachine(object):
+    r"""
+    A compact representation of the FSM built by :class:`FiniteStateMachineBuilder`. Instead of
+    a dense ``(num_total_states, num_total_states, vocab_size)`` adjacency matrix, it keeps one
+    "default" next state per state (a self-loop for main states, the reset state for sub-states),
+    the words which do not follow this default transition, and explicit transitions for
+    constraint word-forms. The dense adjacency matrix is only materialized by :meth:`to_tensor`.
+
+    Parameters
+    ----------
+    num_main_states: int
+        Number of main states, these have self-loops for all words to start with.
+    num_total_states: int
+        Total number of states (main states and sub-states).
+    vocab_size: int
+        Size of the captions vocabulary.
+    """
+
+    def __init__(self, num_main_states: int, num_total_states: int, vocab_size: int):
+        self._vocab_size = vocab_size
+
+        # Default next state for every state, -1 for (unused) sub-states without any transitions.
+        self._default_states = np.full(num_total_states, -1, dtype=np.int64)
+        self._default_states[:num_main_states] = np.arange(num_main_states)
+
+        # Words which do not follow the default transition, keyed by state. Only the few states
+        # touched by :meth:`connect` have an entry, all other words follow the default.
+        self._default_exceptions: Dict[int, List[int]] = {}
 
-        for wordform_index in wordform_indices:
-            fsm[from_state, to_state, wordform_index] = 1
-            fsm[from_state, from_state, wordform_index] = 0
+        # Transitions for constraint word-forms, as flat lists of (from_state, to_state, word)
+        # triplets. These are written to the adjacency matrix at once in :meth:`to_tensor`.
+        self._transition_from_states: List[int] = []
+        self._transition_to_states: List[int] = []
+        self._transition_words: List[int] = []
+
+    def connect(
+        self, from_state: int, to_state: int, word_indices: List[int], reset_state: int = None
+    ):
+        r"""
+        Connect ``from_state`` to ``to_state`` for given word indices. Refer
+        :meth:`FiniteStateMachineBuilder._connect` for details.
+        """
+        self._transition_from_states.extend([from_state] * len(word_indices))
+        self._transition_to_states.extend([to_state] * len(word_indices))
+        self._transition_words.extend(word_indices)
 
         if reset_state is not None:
-            fsm[from_state, from_state, :] = 0
-            fsm[from_state, reset_state, :] = 1
-            for wordform_index in wordform_indices:
-                fsm[from_state, reset_state, wordform_index] = 0
+            # All other words reset back to ``reset_state``, this replaces the default transition.
+            self._default_states[from_state] = reset_state
+            self._default_exceptions[from_state] = list(word_indices)
+        elif self._default_states[from_state] == from_state:
+            # Remove self-loop for these words.
+            self._default_exceptions.setdefault(from_state, []).extend(word_indices)
+
+    def to_tensor(self, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+        r"""
+        Expand this FSM to a dense adjacency matrix.
+
+        Parameters
+        ----------
+        out: torch.Tensor, optional (default = None)
+            A zero-filled ``torch.uint8`` tensor of shape ``(num_states, num_states, vocab_size)``
+            to write the adjacency matrix in, for example a slice of a batch tensor. Unused
+            sub-states have no transitions, so ``num_states`` may be smaller than the total
+            number of states, as long as it covers all used states.
+
+        Returns
+        -------
+        torch.Tensor
+            A tensor of shape ``(num_states, num_states, vocab_size)``, where
+            ``fsm[S1, S2, W] = 1`` indicates a transition from "S1" to "S2" on decoding "W".
+        """
+        fsm = out
+        if fsm is None:
+            num_total_states = self._default_states.shape[0]
+            fsm = torch.zeros(
+                num_total_states, num_total_states, self._vocab_size, dtype=torch.uint8
+            )
+
+        default_states = torch.from_numpy(self._default_states)
+        states = torch.from_numpy(np.flatnonzero(self._default_states >= 0))
+        fsm[states, default_states[states]] = 1
+
+        # Remove default transitions for words which go elsewhere.
+        exception_states: List[int] = []
+        exception_words: List[int] = []
+        for state, words in self._default_exceptions.items():
+            exception_states.extend([state] * len(words))
+            exception_words.extend(words)
+
+        from_states = torch.tensor(exception_states, dtype=torch.long)
+        fsm[
+            from_states,
+            default_states[from_states],
+            torch.tensor(exception_words, dtype=torch.long),
+        ] = 0
+
+        fsm[
+            torch.tensor(self._transition_from_states, dtype=torch.long),
+            torch.tensor(self._transition_to_states, dtype=torch.long),
+            torch.tensor(self._transition_words, dtype=torch.long),
+        ] = 1
 
         return fsm